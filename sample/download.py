@@ -1,4 +1,5 @@
 import asyncio
+import contextlib
 import os
 from ddgimage import Client, DDGSearchException
 
@@ -8,6 +9,7 @@ SEARCH_QUERY = "Red Panda"  # The search term for images
 MAX_IMAGES_TO_DOWNLOAD = 10 # Maximum number of images to download  
 OUTPUT_DIR = "image_downloads"  # Directory to save downloaded images
 MIN_PIXELS = 1_000_000  # 1 Megapixel
+DOWNLOAD_CONCURRENCY = 8  # Maximum number of simultaneous downloads
 
 async def main():
     """
@@ -27,49 +29,67 @@ async def main():
 
     # Instantiate the client
     client = Client()
+    selected = []
     downloaded_count = 0
+    skipped_count = 0
 
     try:
         # Use an async for loop to iterate through the search results
-        # NEW: Added safesearch="off" to the function call
-        async for result in client.asearch(SEARCH_QUERY, safesearch="-1"): # Search with Safe Search ("on": "1", "moderate": "-1", "off": "-2")
-            if downloaded_count >= MAX_IMAGES_TO_DOWNLOAD:
-                print("\nReached the desired number of downloads. Stopping.")
-                break
+        # Images smaller than MIN_PIXELS are filtered out inside asearch, and
+        # max_results stops the search (and its page prefetching) once enough images are found
+        search = client.asearch(
+            SEARCH_QUERY,
+            max_results=MAX_IMAGES_TO_DOWNLOAD,
+            safesearch="-1",  # Search with Safe Search ("on": "1", "moderate": "-1", "off": "-2")
+            min_pixels=MIN_PIXELS,
+        )
+        async with contextlib.aclosing(search):
+            async for result in search:
+                print(f"\nFound Image: '{result.title}'")
+                print(f"  Dimensions: {result.width}x{result.height}")
+                print(f"  Source URL: {result.image_url}")
+                selected.append(result)
 
-            print(f"\nFound Image: '{result.title}'")
-            print(f"  Dimensions: {result.width}x{result.height}")
+        # Download the selected images concurrently, at most DOWNLOAD_CONCURRENCY at a time
+        print(f"\n-> Downloading {len(selected)} image(s)...")
+        sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
 
-            # NEW: Check if the image meets the minimum resolution requirement
-            total_pixels = result.width * result.height
-            if total_pixels < MIN_PIXELS:
-                print(f"  -> Skipping: Image is smaller than {MIN_PIXELS / 1_000_000}MP.")
-                continue
+        async def _dl(result):
+            async with sem:
+                return await client.download(str(result.image_url), OUTPUT_DIR)
 
-            print(f"  Source URL: {result.image_url}")
-
-            try:
-                # Attempt to download the image
-                print(f"-> Attempting to download...")
-                await client.download(str(result.image_url), OUTPUT_DIR)
-                downloaded_count += 1
-                print(f"-> Success! Downloaded to '{OUTPUT_DIR}'. ({downloaded_count}/{MAX_IMAGES_TO_DOWNLOAD})")
-
-            except DDGSearchException as e:
+        outcomes = await asyncio.gather(*(_dl(r) for r in selected), return_exceptions=True)
+        for result, outcome in zip(selected, outcomes):
+            if isinstance(outcome, DDGSearchException):
                 # Handle potential download errors gracefully
-                print(f"-> Download failed. Error: {e}")
-            except Exception as e:
-                print(f"-> An unexpected error occurred during download: {e}")
+                print(f"-> Download failed for {result.image_url}. Error: {outcome}")
+            elif isinstance(outcome, Exception):
+                print(f"-> An unexpected error occurred downloading {result.image_url}: {outcome}")
+            elif outcome is None:
+                # download() returns None when a file with the same name already exists
+                skipped_count += 1
+                print(f"-> Skipped {result.image_url}: a file with the same name already exists in '{OUTPUT_DIR}'.")
+            else:
+                downloaded_count += 1
+                print(f"-> Success! Downloaded {result.image_url} to '{outcome}'. ({downloaded_count}/{MAX_IMAGES_TO_DOWNLOAD})")
 
     except DDGSearchException as e:
         print(f"\nAn error occurred during the search: {e}")
     except Exception as e:
         print(f"\nAn unexpected and critical error occurred: {e}")
+    finally:
+        await client.close()
 
     print("-" * 40)
-    print(f"--- Test Complete. Total images downloaded: {downloaded_count} ---")
+    print(f"--- Test Complete. Total images downloaded: {downloaded_count}, skipped: {skipped_count} ---")
 
 
 if __name__ == "__main__":
-    # This is the standard way to run an async main function
-    asyncio.run(main())
\ No newline at end of file
+    # Use uvloop's faster event loop when it is installed (pip install "ddgimage[uvloop]"),
+    # otherwise fall back to the standard way to run an async main function
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
\ No newline at end of file
@@ -1,14 +1,79 @@
+import asyncio
+import contextlib
 import os
-import httpx
-import aiofiles
+import aiohttp
+import orjson
 import re
-from urllib.parse import urljoin
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
 from typing import AsyncGenerator, Optional
-from bs4 import BeautifulSoup
+from pydantic import TypeAdapter, ValidationError
 
 from .exceptions import VQDTokenError, ParsingError, NetworkError
 from .models import ImageResult
 
+# Read size for streamed downloads. Larger chunks mean fewer coroutine resumptions
+# and write calls per image, at the cost of one 128 KiB buffer per active download.
+DOWNLOAD_CHUNK_SIZE = 128 * 1024
+# Connection pool sizing: one long-lived pool shared by DuckDuckGo and image hosts.
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 16
+KEEPALIVE_TIMEOUT = 30.0
+DNS_CACHE_TTL = 300
+# Extra attempts for requests that fail while establishing a connection.
+CONNECT_RETRIES = 2
+# VQD tokens are reused for repeated queries within this many seconds.
+VQD_CACHE_TTL = 300.0
+VQD_CACHE_SIZE = 128
+# Sidecar file in each download directory holding cache validators per image URL.
+ETAGS_FILENAME = ".etags.json"
+
+SAFESEARCH_MAP = {"on": "1", "moderate": "-1", "off": "-2"}
+
+# Response validator header -> conditional request header that echoes it back.
+_CONDITIONAL_HEADERS = {"ETag": "If-None-Match", "Last-Modified": "If-Modified-Since"}
+_FILTER_NAMES = ("time", "size", "color", "type", "layout", "license")
+_RESULTS_ADAPTER = TypeAdapter(list[ImageResult])
+_NEXT_OFFSET_RE = re.compile(r"[?&]s=(\d+)")
+_UNSAFE_FILENAME_RE = re.compile(r"[^A-Za-z0-9._-]")
+_VQD_RE = re.compile(rb"vqd=['\"]([a-zA-Z0-9-]+)['\"]")
+
+
+def _validate_results(results: list) -> list[ImageResult]:
+    """Validate a page of raw results, dropping any that are malformed."""
+    try:
+        return _RESULTS_ADAPTER.validate_python(results)
+    except ValidationError:
+        pass
+    validated = []
+    for res in results:
+        try:
+            validated.append(ImageResult.model_validate(res))
+        except ValidationError:
+            continue
+    return validated
+
+
+def _is_client_error(error: Exception) -> bool:
+    cause = error.__cause__
+    return isinstance(cause, aiohttp.ClientResponseError) and 400 <= cause.status < 500
+
+
+def _pixel_count(res: dict) -> int:
+    try:
+        return int(res.get("width") or 0) * int(res.get("height") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _write_atomic(path: str, data: bytes):
+    with open(path + ".part", "wb") as f:
+        f.write(data)
+    os.replace(path + ".part", path)
+
+
 class Client:
     """An asynchronous client for searching images on DuckDuckGo."""
 
@@ -29,31 +94,189 @@ class Client:
         }
         if headers:
             default_headers.update(headers)
-        if proxies is not None:
-            self._http_client = httpx.AsyncClient(
-                headers=default_headers, proxies=proxies, timeout=timeout, http2=True
+        self._headers = default_headers
+        # Like httpx, bound each connect/read wait rather than the whole request, so
+        # large downloads aren't cut off while data is still arriving.
+        self._timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=timeout, sock_read=timeout
+        )
+        # aiohttp takes a single proxy URL; prefer the HTTPS entry of an httpx-style mapping.
+        self._proxy = None
+        if proxies:
+            self._proxy = (
+                proxies.get("https://")
+                or proxies.get("all://")
+                or next(iter(proxies.values()))
             )
-        else:
-            self._http_client = httpx.AsyncClient(
-                headers=default_headers, timeout=timeout, http2=True
+        # The session binds to the running event loop, so it is created on first use.
+        self._http_client: Optional[aiohttp.ClientSession] = None
+        # LRU of lowercased keywords -> (vqd token, time fetched).
+        self._vqd_cache: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        # output_dir -> {url: {validator header: value}}, written back by save_etags().
+        self._etags: dict[str, dict[str, dict[str, str]]] = {}
+        self._etags_dirty: set[str] = set()
+        self._etags_lock = asyncio.Lock()
+        # Download directories already created, so each is only made once.
+        self._ensured_dirs: set[str] = set()
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self._http_client is None or self._http_client.closed:
+            self._http_client = aiohttp.ClientSession(
+                headers=self._headers,
+                connector=aiohttp.TCPConnector(
+                    limit=MAX_CONNECTIONS,
+                    limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=DNS_CACHE_TTL,
+                ),
+                timeout=self._timeout,
             )
+        return self._http_client
+
+    @contextlib.asynccontextmanager
+    async def _request(self, method: str, url: str, **kwargs):
+        """Send a request, retrying connection failures, and release it on exit."""
+        # Passed per request: ClientSession only accepts a proxy in newer aiohttp releases.
+        if self._proxy is not None:
+            kwargs.setdefault("proxy", self._proxy)
+        for attempt in range(CONNECT_RETRIES + 1):
+            try:
+                response = await self._session().request(method, url, **kwargs)
+                break
+            except aiohttp.ClientConnectorError:
+                if attempt == CONNECT_RETRIES:
+                    raise
+        try:
+            yield response
+        finally:
+            response.release()
+
+    def _load_etags(self, output_dir: str) -> dict[str, dict[str, str]]:
+        etags = self._etags.get(output_dir)
+        if etags is None:
+            try:
+                with open(os.path.join(output_dir, ETAGS_FILENAME), "rb") as f:
+                    etags = orjson.loads(f.read())
+            except (OSError, ValueError):
+                etags = {}
+            self._etags[output_dir] = etags
+        return etags
+
+    async def save_etags(self):
+        """Write cache validators recorded by download() to each directory's sidecar file."""
+        async with self._etags_lock:
+            dirty, self._etags_dirty = self._etags_dirty, set()
+            for output_dir in dirty:
+                # Serialize on the loop so downloads can't mutate the dict mid-dump.
+                data = orjson.dumps(self._etags[output_dir])
+                await asyncio.to_thread(
+                    _write_atomic, os.path.join(output_dir, ETAGS_FILENAME), data
+                )
+
+    async def close(self):
+        """Save pending cache validators, then close the HTTP session."""
+        try:
+            await self.save_etags()
+        finally:
+            if self._http_client is not None and not self._http_client.closed:
+                await self._http_client.close()
+
+    async def __aenter__(self) -> "Client":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     async def _get_vqd(self, keywords: str) -> str:
+        key = keywords.lower()
+        entry = self._vqd_cache.get(key)
+        if entry is not None and time.monotonic() - entry[1] < VQD_CACHE_TTL:
+            self._vqd_cache.move_to_end(key)
+            return entry[0]
         try:
-            response = await self._http_client.post(
-                "https://duckduckgo.com/", data={"q": keywords}
-            )
-            response.raise_for_status()
-        except httpx.RequestError as e:
+            async with self._request(
+                "POST", "https://duckduckgo.com/", data={"q": keywords}
+            ) as response:
+                response.raise_for_status()
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             raise NetworkError(f"Network error while fetching VQD token: {e}") from e
         try:
-            text = response.text if hasattr(response, 'text') else response.content.decode(errors='ignore')
-            match = re.search(r"vqd=['\"]([a-zA-Z0-9-]+)['\"]", text)
-            if match:
-                return match.group(1)
-            raise VQDTokenError("Failed to extract VQD token from the response.")
+            # Match on the raw bytes; only the token itself is decoded.
+            match = _VQD_RE.search(body)
+            if not match:
+                raise VQDTokenError("Failed to extract VQD token from the response.")
+            vqd = match.group(1).decode("ascii")
         except Exception as e:
             raise VQDTokenError("Failed to extract VQD token from the response.") from e
+        self._vqd_cache[key] = (vqd, time.monotonic())
+        self._vqd_cache.move_to_end(key)
+        while len(self._vqd_cache) > VQD_CACHE_SIZE:
+            self._vqd_cache.popitem(last=False)
+        return vqd
+
+    async def _fetch_page(self, params: dict) -> dict:
+        try:
+            async with self._request(
+                "GET", "https://duckduckgo.com/i.js", params=params
+            ) as response:
+                response.raise_for_status()
+                body = await response.read()
+                try:
+                    return orjson.loads(body)
+                except ValueError as e:
+                    raise ParsingError(f"Failed to parse JSON response: {e}") from e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise NetworkError(f"Network error during search request: {e}") from e
+
+    async def _paginate(self, params: dict, queue: asyncio.Queue, prefetch_pages: int):
+        """Fetch result pages into ``queue``, ``prefetch_pages`` requests at a time.
+
+        Batches are put in page order, followed by ``None`` once pagination ends.
+        Errors are forwarded through the queue so the consumer can re-raise them.
+        """
+        try:
+            offsets = [0]
+            seen = set(offsets)
+            while offsets:
+                # Pages past the end are speculative: their errors only matter if reached.
+                pages = await asyncio.gather(
+                    *(self._fetch_page({**params, "s": str(o)}) for o in offsets),
+                    return_exceptions=True,
+                )
+                start = step = 0
+                for i, (offset, data) in enumerate(zip(offsets, pages)):
+                    if isinstance(data, BaseException):
+                        raise data
+                    results = data.get("results")
+                    if results:
+                        await queue.put(results)
+                    next_page = data.get("next")
+                    if not results or not next_page:
+                        offsets = []
+                        break
+                    # DDG's "next" is a relative URL like "i.js?s=100&..."; trust its
+                    # offset over our own count so pages neither overlap nor get skipped.
+                    match = _NEXT_OFFSET_RE.search(next_page)
+                    start = int(match.group(1)) if match else offset + len(results)
+                    step = start - offset
+                    if i + 1 < len(offsets) and offsets[i + 1] != start:
+                        # The rest of the window was speculated from a different page
+                        # size: drop it and continue from the declared offset instead.
+                        seen.difference_update(offsets[i + 1:])
+                        break
+                if offsets and step > 0:
+                    offsets = [
+                        o for o in range(start, start + step * prefetch_pages, step)
+                        if o not in seen
+                    ]
+                    seen.update(offsets)
+                else:
+                    offsets = []
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
 
     async def asearch(
         self,
@@ -67,84 +290,156 @@ class Client:
         type_image: Optional[str] = None,
         layout: Optional[str] = None,
         license_image: Optional[str] = None,
+        prefetch_pages: int = 4,
+        min_pixels: Optional[int] = None,
     ) -> AsyncGenerator:
+        if prefetch_pages < 1:
+            raise ValueError("prefetch_pages must be at least 1")
         vqd = await self._get_vqd(keywords)
         results_yielded = 0
-        offset = 0
-        safesearch_map = {"on": "1", "moderate": "-1", "off": "-2"}
-        p_value = safesearch_map.get(safesearch.lower(), "-1")
-        filters = [
-            f"time:{timelimit}" if timelimit else "",
-            f"size:{size}" if size else "",
-            f"color:{color}" if color else "",
-            f"type:{type_image}" if type_image else "",
-            f"layout:{layout}" if layout else "",
-            f"license:{license_image}" if license_image else "",
-        ]
-        f_value = ",".join(filter(None, filters))
-        while True:
-            params = {
-                "l": region,
-                "o": "json",
-                "q": keywords,
-                "s": str(offset),
-                "p": p_value,
-                "f": f_value,
-                "vqd": vqd,
-            }
-            try:
-                response = await self._http_client.get(
-                    "https://duckduckgo.com/i.js", params=params
-                )
-                response.raise_for_status()
-            except httpx.RequestError as e:
-                raise NetworkError(f"Network error during search request: {e}") from e
-            try:
-                data = response.json()
-            except Exception as e:
-                raise ParsingError(f"Failed to parse JSON response: {e}") from e
-            results = data.get("results",)
-            if not results:
-                break
-            for res in results:
-                if max_results is not None and results_yielded >= max_results:
-                    return
-                try:
-                    yield ImageResult.model_validate(res)
+        p_value = SAFESEARCH_MAP.get(safesearch.lower(), "-1")
+        filters = (timelimit, size, color, type_image, layout, license_image)
+        if any(filters):
+            f_value = ",".join(
+                f"{name}:{value}" for name, value in zip(_FILTER_NAMES, filters) if value
+            )
+        else:
+            f_value = ""
+        params = {
+            "l": region,
+            "o": "json",
+            "q": keywords,
+            "p": p_value,
+            "f": f_value,
+            "vqd": vqd,
+        }
+        queue: asyncio.Queue = asyncio.Queue(maxsize=prefetch_pages)
+        producer = asyncio.create_task(
+            self._paginate(params, queue, prefetch_pages)
+        )
+        retried = False
+        seen_images: set = set()
+        try:
+            while max_results is None or results_yielded < max_results:
+                results = await queue.get()
+                if results is None:
+                    break
+                if isinstance(results, Exception):
+                    if not retried and not results_yielded and _is_client_error(results):
+                        # DDG rejects an expired VQD token with a 4xx: refresh it and start over.
+                        # Connection failures were already retried by _request.
+                        retried = True
+                        self._vqd_cache.pop(keywords.lower(), None)
+                        params["vqd"] = await self._get_vqd(keywords)
+                        queue = asyncio.Queue(maxsize=prefetch_pages)
+                        producer = asyncio.create_task(
+                            self._paginate(params, queue, prefetch_pages)
+                        )
+                        continue
+                    raise results
+                # Pages can overlap; never yield the same image twice.
+                unseen = []
+                for res in results:
+                    image_url = res.get("image")
+                    if image_url not in seen_images:
+                        seen_images.add(image_url)
+                        unseen.append(res)
+                results = unseen
+                if min_pixels is not None:
+                    # Filter on the raw dicts so rejected images are never validated.
+                    results = [res for res in results if _pixel_count(res) >= min_pixels]
+                images = _validate_results(results)
+                if max_results is not None:
+                    # Trim after validation so invalid entries don't use up the quota.
+                    images = images[: max_results - results_yielded]
+                for image in images:
+                    yield image
                     results_yielded += 1
-                except Exception:
-                    continue
-            if "next" not in data:
-                break
-            offset += len(results)
+        finally:
+            producer.cancel()
 
     async def get_images_from_page(self, url: str) -> list[str]:
+        # Imported here so plain image searches don't pay lxml's import cost.
+        import lxml.html
+
         try:
-            response = await self._http_client.get(url)
-            response.raise_for_status()
-        except httpx.RequestError as e:
+            async with self._request("GET", url) as response:
+                response.raise_for_status()
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             raise NetworkError(f"Network error while fetching page: {e}") from e
         try:
-            soup = BeautifulSoup(response.text, "lxml")
-            img_tags = soup.find_all("img")
-            image_urls = [img.get("src") for img in img_tags if img.get("src")]
-            absolute_image_urls = [urljoin(url, img_url) for img_url in image_urls]
-            return absolute_image_urls
+            # XPath straight to the attribute values: no per-tag Python wrappers.
+            image_urls = lxml.html.fromstring(body).xpath("//img/@src")
+            return [urljoin(url, img_url) for img_url in image_urls if img_url]
         except Exception as e:
             raise ParsingError(f"Failed to parse HTML from {url}: {e}") from e
 
-    async def download(self, url: str, output_dir: str, filename: Optional[str] = None):
+    async def download(
+        self,
+        url: str,
+        output_dir: str,
+        filename: Optional[str] = None,
+        revalidate: bool = False,
+    ) -> Optional[str]:
+        """Download ``url`` into ``output_dir``, named after the URL path by default.
+
+        Returns the path written, or ``None`` if nothing was written. That happens
+        when a non-empty file already exists at the target path. Such a file is
+        treated as a completed earlier download, even if it came from a different
+        URL with the same name. With ``revalidate=True`` it is instead checked
+        with a conditional GET, using the ETag/Last-Modified recorded (in
+        ``.etags.json``) by earlier revalidating downloads, and ``None`` means
+        the server answered 304 Not Modified.
+        """
         if not filename:
-            filename = url.split("/")[-1].split("?")[0]
-            if not filename:
+            filename = _UNSAFE_FILENAME_RE.sub("_", os.path.basename(urlparse(url).path))[:200]
+            if not filename.strip("."):
                 filename = "downloaded_image"
         output_path = os.path.join(output_dir, filename)
-        os.makedirs(output_dir, exist_ok=True)
+        headers = {}
+        # A non-empty file at the final path is a completed earlier download. It is
+        # kept as is, or with revalidate=True checked with a conditional GET.
+        if os.path.isfile(output_path) and os.path.getsize(output_path) > 0:
+            if not revalidate:
+                return None
+            for name, value in self._load_etags(output_dir).get(url, {}).items():
+                headers[_CONDITIONAL_HEADERS[name]] = value
+        if output_dir not in self._ensured_dirs:
+            os.makedirs(output_dir, exist_ok=True)
+            self._ensured_dirs.add(output_dir)
+        # A unique temp file, so concurrent downloads that share a filename don't
+        # write into each other.
+        # (mkstemp is avoided because it would leave images with 0600 permissions.)
+        tmp_path = f"{output_path}.{uuid.uuid4().hex}.part"
         try:
-            async with self._http_client.stream("GET", url) as response:
+            async with self._request("GET", url, headers=headers) as response:
+                if response.status == 304:
+                    return None
                 response.raise_for_status()
-                async with aiofiles.open(output_path, "wb") as f:
-                    async for chunk in response.aiter_bytes():
-                        await f.write(chunk)
-        except httpx.RequestError as e:
+                validators = {
+                    name: response.headers[name]
+                    for name in _CONDITIONAL_HEADERS
+                    if name in response.headers
+                }
+                # Plain blocking writes: each chunk is already in memory and a local
+                # write is far cheaper than a thread-pool hop per chunk.
+                with open(tmp_path, "xb") as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            os.replace(tmp_path, output_path)
+            # Validators are only kept (and the sidecar written) for callers that revalidate.
+            if revalidate:
+                etags = self._load_etags(output_dir)
+                if validators:
+                    etags[url] = validators
+                    self._etags_dirty.add(output_dir)
+                elif etags.pop(url, None) is not None:
+                    self._etags_dirty.add(output_dir)
+            return output_path
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             raise NetworkError(f"Failed to download {url}: {e}") from e
+        finally:
+            # Gone after a successful rename; otherwise a partial body is discarded.
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
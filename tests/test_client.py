@@ -1,6 +1,10 @@
+import asyncio
+import aiohttp
 import pytest
-from ddgimage import Client, ImageResult, VQDTokenError
+from ddgimage import Client, ImageResult, NetworkError, VQDTokenError
 import copy
+import json
+import os
 
 # Mark all tests in this file as asyncio
 pytestmark = pytest.mark.asyncio
@@ -30,50 +34,141 @@ FAKE_CRAWL_HTML = """
 </html>
 """
 
+class FakeStream:
+    """Stand-in for aiohttp's StreamReader."""
+    def __init__(self, body: bytes):
+        self._body = body
+
+    async def iter_chunked(self, n):
+        for i in range(0, len(self._body), n):
+            yield self._body[i:i + n]
+
+
+class FakeResponse:
+    """Minimal aiohttp-style response usable as an async context manager."""
+    def __init__(self, body: bytes, status: int = 200, headers=None):
+        self._body = body
+        self.status = status
+        self.headers = headers or {}
+        self.content = FakeStream(body)
+
+    def raise_for_status(self):
+        return None
+
+    def release(self):
+        return None
+
+    async def read(self):
+        return self._body
+
+    async def text(self, errors="strict"):
+        return self._body.decode(errors=errors)
+
+    async def json(self, content_type="application/json"):
+        return json.loads(self._body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
 @pytest.fixture
-def mock_httpx_client(mocker):
-    """Fixture to mock the httpx.AsyncClient."""
-    mock_client = mocker.AsyncMock()
-
-    mock_post_response = mocker.MagicMock()
-    mock_post_response.content = FAKE_VQD_HTML
-    mock_post_response.text = FAKE_VQD_HTML.decode()
-    mock_post_response.raise_for_status.return_value = None
-
-    mock_get_response = mocker.MagicMock()
-    # Simulate pagination: first call returns a result, second call returns empty results and no 'next'
-    first_json = copy.deepcopy(FAKE_IMAGE_JSON)
-    second_json = {"results": [], "next": None}
-    mock_get_response.json.side_effect = [first_json, second_json]
-    mock_get_response.text = FAKE_CRAWL_HTML
-    mock_get_response.raise_for_status.return_value = None
-
-    mock_client.post.return_value = mock_post_response
-    mock_client.get.return_value = mock_get_response
-
-    mocker.patch("httpx.AsyncClient", return_value=mock_client)
-    return mock_client
-
-async def test_get_vqd_success(mock_httpx_client):
+def mock_session(mocker):
+    """Fixture to mock the aiohttp.ClientSession."""
+    session = mocker.MagicMock()
+    session.closed = False
+    session.close = mocker.AsyncMock()
+
+    # Simulate pagination: the first page returns a result, any later offset returns empty results
+    pages = {"0": copy.deepcopy(FAKE_IMAGE_JSON)}
+    session.pages = pages
+
+    def fake_request(method, url, params=None, **kwargs):
+        if method == "POST":
+            return FakeResponse(FAKE_VQD_HTML)
+        if url == "https://duckduckgo.com/i.js":
+            data = pages.get(params["s"], {"results": [], "next": None})
+            return FakeResponse(json.dumps(data).encode())
+        return FakeResponse(FAKE_CRAWL_HTML.encode())
+
+    session.request = mocker.AsyncMock(side_effect=fake_request)
+
+    mocker.patch("aiohttp.ClientSession", return_value=session)
+    mocker.patch("aiohttp.TCPConnector")
+    return session
+
+async def test_get_vqd_success(mock_session):
     """Test that _get_vqd successfully extracts the token."""
     client = Client()
     vqd = await client._get_vqd("test")
     assert vqd == "some-fake-vqd-token-12345"
-    mock_httpx_client.post.assert_called_once()
+    mock_session.request.assert_called_once()
 
 async def test_get_vqd_failure(mocker):
     """Test that _get_vqd raises VQDTokenError on failure."""
-    mock_client = mocker.AsyncMock()
-    mock_response = mocker.MagicMock()
-    mock_response.content = b"<html>no token here</html>"
-    mock_client.post.return_value = mock_response
-    mocker.patch("httpx.AsyncClient", return_value=mock_client)
+    session = mocker.MagicMock()
+    session.closed = False
+    session.request = mocker.AsyncMock(return_value=FakeResponse(b"<html>no token here</html>"))
+    mocker.patch("aiohttp.ClientSession", return_value=session)
+    mocker.patch("aiohttp.TCPConnector")
 
     client = Client()
     with pytest.raises(VQDTokenError):
         await client._get_vqd("test")
 
-async def test_asearch_yields_results(mock_httpx_client):
+async def test_get_vqd_is_cached_per_keywords(mock_session):
+    """Test that repeated lookups for the same keywords reuse the cached token."""
+    client = Client()
+    first = await client._get_vqd("Red Panda")
+    second = await client._get_vqd("red panda")
+
+    assert first == second == "some-fake-vqd-token-12345"
+    mock_session.request.assert_called_once()
+
+
+async def test_asearch_refreshes_expired_vqd(mock_session, mocker):
+    """Test that asearch drops a cached token and retries once when the search request fails."""
+    client = Client()
+    await client._get_vqd("red panda")
+    fake_request = mock_session.request.side_effect
+    expired = aiohttp.ClientResponseError(mocker.MagicMock(), (), status=403)
+    responses = [expired]
+
+    def first_search_fails(method, url, **kwargs):
+        if method == "GET" and responses:
+            raise responses.pop()
+        return fake_request(method, url, **kwargs)
+
+    mock_session.request.side_effect = first_search_fails
+    results = [res async for res in client.asearch("red panda", max_results=1)]
+
+    assert len(results) == 1
+    methods = [c.args[0] for c in mock_session.request.call_args_list]
+    assert methods.count("POST") == 2
+
+
+async def test_asearch_does_not_refresh_vqd_on_connection_errors(mock_session, mocker):
+    """Test that connection failures are not mistaken for an expired VQD token."""
+    client = Client()
+    fake_request = mock_session.request.side_effect
+    connect_error = aiohttp.ClientConnectorError(mocker.MagicMock(), OSError("refused"))
+
+    def search_unreachable(method, url, **kwargs):
+        if method == "GET":
+            raise connect_error
+        return fake_request(method, url, **kwargs)
+
+    mock_session.request.side_effect = search_unreachable
+    with pytest.raises(NetworkError):
+        [res async for res in client.asearch("red panda")]
+
+    methods = [c.args[0] for c in mock_session.request.call_args_list]
+    assert methods.count("POST") == 1
+
+
+async def test_asearch_yields_results(mock_session):
     """Test that asearch yields ImageResult objects."""
     client = Client()
     results = [res async for res in client.asearch("red panda", max_results=1)]
@@ -84,10 +179,164 @@ async def test_asearch_yields_results(mock_httpx_client):
     assert result.title == "A Red Panda"
     assert str(result.image_url) == "https://example.com/red_panda.jpg"
     
-    mock_httpx_client.post.assert_called_once()
-    assert mock_httpx_client.get.call_count == 2
+    assert mock_session.request.call_args_list[0].args[0] == "POST"
+    assert mock_session.request.call_args_list[1].kwargs["params"]["s"] == "0"
+
+
+async def test_asearch_prefetches_pages_in_order(mock_session):
+    """Test that prefetched pages are yielded in offset order without duplicates."""
+    second = copy.deepcopy(FAKE_IMAGE_JSON)
+    second["results"][0]["title"] = "Second Page"
+    second["results"][0]["image"] = "https://example.com/second.jpg"
+    third = copy.deepcopy(FAKE_IMAGE_JSON)
+    third["results"][0]["title"] = "Third Page"
+    third["results"][0]["image"] = "https://example.com/third.jpg"
+    del third["next"]
+    mock_session.pages.update({"1": second, "2": third})
+
+    client = Client()
+    results = [res async for res in client.asearch("red panda", prefetch_pages=2)]
+
+    assert [r.title for r in results] == ["A Red Panda", "Second Page", "Third Page"]
+    offsets = [c.kwargs["params"]["s"] for c in mock_session.request.call_args_list[1:]]
+    assert offsets == ["0", "1", "2"]
+
+
+async def test_asearch_restarts_window_when_next_disagrees(mock_session):
+    """Test that a page declaring a different next offset resets the speculative window."""
+    pages = {}
+    for offset, next_offset in (("0", 100), ("100", 180), ("180", None)):
+        page = copy.deepcopy(FAKE_IMAGE_JSON)
+        page["results"][0]["title"] = f"P{offset}"
+        page["results"][0]["image"] = f"https://example.com/{offset}.jpg"
+        if next_offset is None:
+            del page["next"]
+        else:
+            page["next"] = f"i.js?q=red+panda&s={next_offset}"
+        pages[offset] = page
+    mock_session.pages.update(pages)
+
+    client = Client()
+    results = [res async for res in client.asearch("red panda", prefetch_pages=3)]
+
+    assert [r.title for r in results] == ["P0", "P100", "P180"]
+
+
+async def test_asearch_ignores_errors_on_unreached_pages(mock_session, mocker):
+    """Test that a failing speculative page past the last one doesn't abort the search."""
+    second = copy.deepcopy(FAKE_IMAGE_JSON)
+    second["results"][0]["title"] = "Second Page"
+    second["results"][0]["image"] = "https://example.com/second.jpg"
+    del second["next"]
+    mock_session.pages["1"] = second
+    fake_request = mock_session.request.side_effect
+
+    def past_the_end_fails(method, url, params=None, **kwargs):
+        if params and params["s"] == "2":
+            raise aiohttp.ClientResponseError(mocker.MagicMock(), (), status=403)
+        return fake_request(method, url, params=params, **kwargs)
+
+    mock_session.request.side_effect = past_the_end_fails
+    client = Client()
+    results = [res async for res in client.asearch("red panda", prefetch_pages=3)]
+
+    assert [r.title for r in results] == ["A Red Panda", "Second Page"]
+
+
+async def test_asearch_rejects_invalid_prefetch_pages(mock_session):
+    """Test that prefetch_pages below 1 is rejected."""
+    client = Client()
+    with pytest.raises(ValueError):
+        [res async for res in client.asearch("red panda", prefetch_pages=0)]
+
+
+async def test_asearch_follows_next_offset_and_dedupes(mock_session):
+    """Test that pagination advances by the offset in 'next' and skips repeated images."""
+    first = copy.deepcopy(FAKE_IMAGE_JSON)
+    first["next"] = "i.js?q=red+panda&o=json&s=100&vqd=abc"
+    repeat = copy.deepcopy(FAKE_IMAGE_JSON)
+    repeat["results"].append({**repeat["results"][0], "title": "New", "image": "https://example.com/new.jpg"})
+    repeat["results"].append({**repeat["results"][1], "title": "New Again"})
+    del repeat["next"]
+    mock_session.pages.update({"0": first, "100": repeat})
+
+    client = Client()
+    results = [res async for res in client.asearch("red panda", prefetch_pages=1)]
+
+    assert [r.title for r in results] == ["A Red Panda", "New"]
+    offsets = [c.kwargs["params"]["s"] for c in mock_session.request.call_args_list[1:]]
+    assert offsets == ["0", "100"]
+
+
+async def test_asearch_max_results_counts_only_usable_results(mock_session):
+    """Test that invalid and repeated results don't count towards max_results."""
+    page = copy.deepcopy(FAKE_IMAGE_JSON)
+    page["results"] = [
+        {**page["results"][0], "title": f"Panda {i}", "image": f"https://example.com/{i}.jpg"}
+        for i in range(500)
+    ]
+    page["results"][0] = {"title": "Broken", "image": "not a url"}
+    page["results"][2] = page["results"][1]
+    mock_session.pages["0"] = page
+
+    client = Client()
+    results = [res async for res in client.asearch("red panda", max_results=3)]
+
+    assert [r.title for r in results] == ["Panda 1", "Panda 3", "Panda 4"]
+
 
-async def test_get_images_from_page(mock_httpx_client):
+async def test_asearch_filters_by_min_pixels(mock_session):
+    """Test that results below min_pixels are dropped before validation."""
+    page = copy.deepcopy(FAKE_IMAGE_JSON)
+    small = page["results"][0]
+    page["results"] = [
+        {**small, "title": "Small", "image": "https://example.com/small.jpg"},
+        {**small, "title": "No Size", "image": "https://example.com/nosize.jpg", "width": None},
+        {**small, "title": "Large", "image": "https://example.com/large.jpg", "width": 2000, "height": 1000},
+    ]
+    del page["next"]
+    mock_session.pages["0"] = page
+
+    client = Client()
+    results = [res async for res in client.asearch("red panda", max_results=1, min_pixels=1_000_000)]
+
+    assert [r.title for r in results] == ["Large"]
+
+
+async def test_asearch_stops_prefetching_once_satisfied(mock_session):
+    """Test that no further pages are requested once max_results is reached."""
+    client = Client()
+    results = [res async for res in client.asearch("red panda", max_results=1, min_pixels=1)]
+
+    assert len(results) == 1
+    searches = [c for c in mock_session.request.call_args_list if c.args[0] == "GET"]
+    assert len(searches) == 1
+
+
+async def test_asearch_builds_filter_params(mock_session):
+    """Test that safesearch and image filters are encoded into the search params."""
+    client = Client()
+    [res async for res in client.asearch("red panda", safesearch="Off", size="Large", color="Red")]
+    params = mock_session.request.call_args_list[1].kwargs["params"]
+
+    assert params["p"] == "-2"
+    assert params["f"] == "size:Large,color:Red"
+
+
+async def test_asearch_skips_invalid_results(mock_session):
+    """Test that malformed results are dropped while valid ones on the page are kept."""
+    page = copy.deepcopy(FAKE_IMAGE_JSON)
+    page["results"].insert(0, {"title": "Broken", "image": "not a url"})
+    del page["next"]
+    mock_session.pages["0"] = page
+
+    client = Client()
+    results = [res async for res in client.asearch("red panda")]
+
+    assert [r.title for r in results] == ["A Red Panda"]
+
+
+async def test_get_images_from_page(mock_session):
     """Test that get_images_from_page extracts and resolves image URLs."""
     client = Client()
     page_url = "https://example.com/page.html"
@@ -96,4 +345,143 @@ async def test_get_images_from_page(mock_httpx_client):
     assert len(image_urls) == 2
     assert "https://example.com/images/relative_path_img.jpg" in image_urls
     assert "https://example.com/full_url_img.png" in image_urls
-    mock_httpx_client.get.assert_called_once_with(page_url)
\ No newline at end of file
+    mock_session.request.assert_called_once_with("GET", page_url)
+
+async def test_request_retries_connection_errors(mock_session, mocker):
+    """Test that failed connection attempts are retried before giving up."""
+    connect_error = aiohttp.ClientConnectorError(mocker.MagicMock(), OSError("refused"))
+    mock_session.request.side_effect = [connect_error, FakeResponse(FAKE_VQD_HTML)]
+
+    client = Client()
+    vqd = await client._get_vqd("test")
+
+    assert vqd == "some-fake-vqd-token-12345"
+    assert mock_session.request.call_count == 2
+
+
+async def test_proxy_is_passed_per_request(mock_session):
+    """Test that the configured proxy is sent with each request, not to the session."""
+    client = Client(proxies={"https://": "http://proxy.local:8080"})
+    await client._get_vqd("test")
+
+    assert mock_session.request.call_args.kwargs["proxy"] == "http://proxy.local:8080"
+    assert "proxy" not in aiohttp.ClientSession.call_args.kwargs
+
+
+async def test_timeout_applies_per_phase(mock_session):
+    """Test that the timeout bounds connect/read waits, not the whole request."""
+    client = Client(timeout=7)
+    await client._get_vqd("test")
+
+    timeout = aiohttp.ClientSession.call_args.kwargs["timeout"]
+    assert (timeout.total, timeout.sock_connect, timeout.sock_read) == (None, 7, 7)
+
+
+async def test_download_streams_to_file(mock_session, tmp_path):
+    """Test that download writes the response body to disk."""
+    client = Client()
+    path = await client.download("https://example.com/page.html", str(tmp_path))
+
+    assert path == str(tmp_path / "page.html")
+    assert (tmp_path / "page.html").read_bytes() == FAKE_CRAWL_HTML.encode()
+
+
+async def test_download_skips_existing_and_cleans_partial(mock_session, mocker, tmp_path):
+    """Test that completed files are not re-downloaded and failures leave no partial file."""
+    (tmp_path / "done.jpg").write_bytes(b"cached")
+    client = Client()
+    assert await client.download("https://example.com/done.jpg", str(tmp_path)) is None
+    mock_session.request.assert_not_called()
+
+    mocker.patch.object(FakeStream, "iter_chunked", side_effect=aiohttp.ClientPayloadError("cut"))
+    with pytest.raises(NetworkError):
+        await client.download("https://example.com/broken.jpg", str(tmp_path))
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["done.jpg"]
+    assert (tmp_path / "done.jpg").read_bytes() == b"cached"
+
+
+async def test_download_revalidates_with_stored_etag(mock_session, tmp_path):
+    """Test that ETags are persisted and sent back as If-None-Match on revalidation."""
+    mock_session.request.side_effect = None
+    mock_session.request.return_value = FakeResponse(b"image", headers={"ETag": '"v1"'})
+    async with Client() as client:
+        await client.download("https://example.com/a.jpg", str(tmp_path), revalidate=True)
+    assert json.loads((tmp_path / ".etags.json").read_bytes()) == {
+        "https://example.com/a.jpg": {"ETag": '"v1"'}
+    }
+
+    mock_session.request.return_value = FakeResponse(b"", status=304)
+    async with Client() as client:
+        await client.download("https://example.com/a.jpg", str(tmp_path), revalidate=True)
+
+    headers = mock_session.request.call_args.kwargs["headers"]
+    assert headers == {"If-None-Match": '"v1"'}
+    assert (tmp_path / "a.jpg").read_bytes() == b"image"
+
+
+async def test_download_without_revalidate_writes_no_etags(mock_session, tmp_path):
+    """Test that plain downloads don't record validators or create the sidecar file."""
+    mock_session.request.side_effect = None
+    mock_session.request.return_value = FakeResponse(b"image", headers={"ETag": '"v1"'})
+    async with Client() as client:
+        await client.download("https://example.com/a.jpg", str(tmp_path))
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.jpg"]
+
+
+async def test_download_creates_output_dir_once(mock_session, mocker, tmp_path):
+    """Test that the output directory is created on first use only."""
+    makedirs = mocker.spy(os, "makedirs")
+    output_dir = str(tmp_path / "new")
+    client = Client()
+    await client.download("https://example.com/a.jpg", output_dir)
+    await client.download("https://example.com/b.jpg", output_dir)
+
+    makedirs.assert_called_once_with(output_dir, exist_ok=True)
+    assert sorted(p.name for p in (tmp_path / "new").iterdir()) == ["a.jpg", "b.jpg"]
+
+
+async def test_concurrent_downloads_use_separate_temp_files(mock_session, mocker, tmp_path):
+    """Test that same-named concurrent downloads don't share a temp file."""
+    opened = []
+    real_open = open
+
+    def tracking_open(path, mode="r", *args, **kwargs):
+        if mode == "xb":
+            opened.append(path)
+        return real_open(path, mode, *args, **kwargs)
+
+    async def slow_chunks(self, n):
+        await asyncio.sleep(0)
+        yield b"image"
+
+    mocker.patch("builtins.open", side_effect=tracking_open)
+    mocker.patch.object(FakeStream, "iter_chunked", slow_chunks)
+    client = Client()
+    paths = await asyncio.gather(
+        client.download("https://a.example.com/img.jpg", str(tmp_path)),
+        client.download("https://b.example.com/img.jpg", str(tmp_path)),
+    )
+
+    assert len(opened) == 2
+    assert len(set(opened)) == 2
+    assert all(path.endswith(".part") for path in opened)
+    assert paths == [str(tmp_path / "img.jpg")] * 2
+    assert not [p.name for p in tmp_path.iterdir() if p.name.endswith(".part")]
+
+
+async def test_download_derives_safe_filename(mock_session, tmp_path):
+    """Test that download names files after the sanitized URL path."""
+    client = Client()
+    await client.download("https://example.com/img/red%20panda.jpg?w=600#top", str(tmp_path))
+    await client.download("https://example.com/", str(tmp_path))
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["downloaded_image", "red_20panda.jpg"]
+
+
+async def test_client_closes_session(mock_session):
+    """Test that the async context manager closes the HTTP session."""
+    async with Client() as client:
+        await client._get_vqd("test")
+    mock_session.close.assert_awaited_once()
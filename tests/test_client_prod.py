@@ -4,8 +4,8 @@ from ddgimage import Client, ImageResult
 pytestmark = pytest.mark.asyncio
 
 async def test_asearch_real_data():
-    client = Client()
-    results = [res async for res in client.asearch("cat", max_results=1)]
+    async with Client() as client:
+        results = [res async for res in client.asearch("cat", max_results=1)]
     assert len(results) == 1
     result = results[0]
     assert isinstance(result, ImageResult)